@@ -1,32 +1,57 @@
 from importlib import import_module
 
 from enum import Enum
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
+from functools import cached_property, lru_cache, partial
+
+# dataclasses already imports inspect, so there is nothing to gain by deferring it.
 import inspect
-from inspect import Signature
+from inspect import Parameter, Signature
 import sys
-import textwrap
-import types
-import difflib
-import shelve
 import os
 import time
-from collections import namedtuple
-from typing import Dict, Callable, Any
-import shutil
+from typing import Dict, Callable, Any, Mapping, Optional
 import argparse
-from itertools import takewhile
-import traceback
+import atexit
+from bisect import bisect_left
+from operator import itemgetter
 
-from .config import read_namespaces
+from ._version import __version__
 
-NAMESPACE_MODULE_PATHS = read_namespaces()
-# Sorted list of command namespace keys.
-NAMESPACE_KEYS = sorted({"system", *NAMESPACE_MODULE_PATHS.keys()})
+# Pass to @dataclass to avoid a __dict__ per instance where supported (python 3.10+).
+_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
 
-# Load lazily namespace modules as needed. Some have expensive/occasionally
-# failing initialization.
-__NAMESPACES = {}
+
+@lru_cache(maxsize=None)
+def namespace_module_paths():
+    """Mapping from namespace keys to python module paths.
+
+    Read from the clrfile on first use rather than at import time.
+    """
+    from .config import read_namespaces
+
+    return read_namespaces()
+
+
+@lru_cache(maxsize=None)
+def namespace_keys():
+    """Sorted tuple of command namespace keys."""
+    return tuple(sorted(_namespace_key_set()))
+
+
+@lru_cache(maxsize=None)
+def _namespace_key_set():
+    """Set of command namespace keys, for membership checks."""
+    return frozenset({"system", *namespace_module_paths().keys()})
+
+
+def __getattr__(name):
+    """Lazily provide the module constants that used to be computed at import time."""
+    if name == "NAMESPACE_MODULE_PATHS":
+        return namespace_module_paths()
+    if name == "NAMESPACE_KEYS":
+        return namespace_keys()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def _load_namespace(key):
@@ -35,7 +60,7 @@ def _load_namespace(key):
         # Defined at end of file.
         instance = System()
     else:
-        module_path = NAMESPACE_MODULE_PATHS[key]
+        module_path = namespace_module_paths()[key]
         try:
             module = import_module(module_path)
         except Exception as error:
@@ -44,89 +69,207 @@ def _load_namespace(key):
     descr = instance.descr
     # Prefer doc string, otherwise explicit .longdescr, otherwise .descr
     longdescr = inspect.getdoc(instance) or getattr(instance, "longdescr", descr)
-    command_callables = {
-        method_name[4:]: method
-        for method_name, method in inspect.getmembers(instance, inspect.ismethod)
-        if method_name.startswith("cmd_")
-    }
-    # Build CommandSpecs for each command. These contain metadata about the
-    # command and its args. These are kept in a seperate dataclass from the
-    # callables because CommandSpec's are pickle-able and cached to disk.
-    command_specs = {}
-    for command_name, command_callable in command_callables.items():
-        docstr = inspect.getdoc(command_callable)
-        if docstr is None:
-            docstr = ""
-        command_specs[command_name] = CommandSpec(
-            docstr, Signature.from_callable(command_callable)
-        )
-
+    command_callables = {}
+    # Scan the class dicts directly rather than every attribute of the instance. Walk
+    # the mro so inherited commands are included and the most derived definition wins.
+    seen = set()
+    for klass in type(instance).__mro__:
+        for attribute_name in vars(klass):
+            if not attribute_name.startswith("cmd_") or attribute_name in seen:
+                continue
+            seen.add(attribute_name)
+            method = getattr(instance, attribute_name)
+            if inspect.ismethod(method):
+                # Interned, like the namespace keys, see resolve_command.
+                command_callables[sys.intern(attribute_name[4:])] = method
     return Namespace(
         key=key,
         descr=descr,
         longdescr=longdescr,
-        command_specs=command_specs,
+        command_specs=LazyCommandSpecs(command_callables),
         command_callables=command_callables,
         instance=instance,
     )
 
 
+class LazyCommandSpecs(Mapping):
+    """Mapping from command names to CommandSpecs, built as they are looked up.
+
+    CommandSpecs contain metadata about the command and its args. These are kept
+    separate from the callables because CommandSpec's are pickle-able and cached to
+    disk. Running a single command only needs its own spec, so don't introspect
+    every command in the namespace up front.
+    """
+
+    def __init__(self, command_callables):
+        self._command_callables = command_callables
+
+    def __getitem__(self, command_name):
+        return _get_command_spec(self._command_callables[command_name].__func__)
+
+    def __contains__(self, command_name):
+        return command_name in self._command_callables
+
+    def __iter__(self):
+        return iter(self._command_callables)
+
+    def __len__(self):
+        return len(self._command_callables)
+
+
+@lru_cache(maxsize=None)
+def _get_command_spec(function):
+    """Returns the CommandSpec for the function underlying a command method.
+
+    Keyed on the unbound function so the introspection is done once per command
+    regardless of how many times the bound method is looked up.
+    """
+    docstr = inspect.getdoc(function)
+    if docstr is None:
+        docstr = ""
+    signature = Signature.from_callable(function)
+    # Drop `self`, commands are always called as bound methods.
+    parameters = tuple(signature.parameters.values())[1:]
+    var_positional_index = next(
+        (
+            index
+            for index, param in enumerate(parameters)
+            if param.kind == Parameter.VAR_POSITIONAL
+        ),
+        None,
+    )
+    return CommandSpec(
+        docstr,
+        signature.replace(parameters=parameters),
+        tuple(ParamInfo.create(param) for param in parameters),
+        var_positional_index,
+    )
+
+
+# Load lazily namespace modules as needed. Some have expensive/occasionally
+# failing initialization.
+@lru_cache(maxsize=None)
 def get_namespace(namespace_key):
     """Lazily load and return a namespace"""
-    global __NAMESPACES
-    if namespace_key not in __NAMESPACES:
-        __NAMESPACES[namespace_key] = _load_namespace(namespace_key)
-    return __NAMESPACES[namespace_key]
+    return _load_namespace(namespace_key)
+
+
+def get_namespaces(keys):
+    """Loads namespaces and returns them in the same order.
+
+    Many namespace modules do I/O when imported, which overlaps well across threads, so the
+    modules are imported concurrently first. The namespaces are then loaded on this thread.
+    Some modules can only be imported on the main thread (e.g. they install signal handlers).
+    Those fail in the pool and are imported again here, so their errors are only reported and
+    memoized by get_namespace if they fail here too.
+    """
+    keys = list(keys)
+    if len(keys) > 1:
+        _map_concurrently(_import_namespace_module, keys)
+    return [get_namespace(key) for key in keys]
+
+
+def _import_namespace_module(namespace_key):
+    """Imports the namespace's module, if it has one, ignoring errors."""
+    module_path = namespace_module_paths().get(namespace_key)
+    if module_path is None:
+        return
+    try:
+        import_module(module_path)
+    except Exception:
+        pass
+
+
+def _map_concurrently(function, items):
+    """Like list(map(function, items)) but runs in a thread pool."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    items = list(items)
+    if len(items) < 2:
+        return [function(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(32, len(items))) as executor:
+        return list(executor.map(function, items))
 
 
 def _get_close_matches(query, options):
     """Utility function for making suggests when `resolve_command` can't resolve a namespace/command
-    name."""
-    matches = difflib.get_close_matches(query, options, cutoff=0.4)
-    if query:
-        matches.extend(
-            sorted(o for o in options if o.startswith(query) and o not in matches)
+    name.
+
+    `options` should be sorted. Options starting with `query` are returned if there are any,
+    otherwise falls back to the slower fuzzy matching. Fuzzy matching uses rapidfuzz if it is
+    installed, and difflib otherwise.
+    """
+    if not query:
+        return []
+    matches = _with_prefix(options, query)
+    if matches:
+        return list(matches)
+
+    try:
+        from rapidfuzz import fuzz, process
+    except ImportError:
+        import difflib
+
+        return difflib.get_close_matches(query, options, cutoff=0.4)
+    return [
+        match
+        for match, _, _ in process.extract(
+            query, options, scorer=fuzz.ratio, score_cutoff=40, limit=3
         )
-    return matches
+    ]
+
+
+def _with_prefix(options, prefix):
+    """Returns the options starting with prefix. `options` must be sorted."""
+    start = bisect_left(options, prefix)
+    end = start
+    while end < len(options) and options[end].startswith(prefix):
+        end += 1
+    return options[start:end]
 
 
 def resolve_command(query, cache=None):
     """Resolve the string `query' into a (namespace_key, command_name) tuple."""
 
-    if ":" in query:
-        namespace_key, command_name = query.split(":", 1)
-    else:
-        if query in get_namespace("system").commands:
-            # System commands can be referred to w/o a namespace so that `clr help` works as
-            # expected.
-            namespace_key = "system"
-            command_name = query
-        else:
-            # This will still fail, but the error messages will be sensible.
-            namespace_key = query
-            command_name = ""
-
-    if namespace_key not in NAMESPACE_KEYS:
+    # Without a ":" the whole query is taken as the namespace key. This will still fail, but
+    # the error messages will be sensible.
+    namespace_key, separator, command_name = query.partition(":")
+    # Strings from the command line aren't interned, unlike the keys they are looked up against:
+    # namespace keys are string constants in the clrfile, and command names are interned when a
+    # namespace is loaded or scanned. Interning them lets those dict lookups compare by identity.
+    namespace_key = sys.intern(namespace_key)
+    command_name = sys.intern(command_name)
+    if not separator and query in _SYSTEM_COMMANDS:
+        # System commands can be referred to w/o a namespace so that `clr help` works as
+        # expected.
+        namespace_key = "system"
+        command_name = query
+
+    if namespace_key not in _namespace_key_set():
         print(
             f"Error! Command namespace '{namespace_key}' does not exist.\n"
-            f"Closest matches: {_get_close_matches(namespace_key, NAMESPACE_KEYS)}\n\n"
-            f"Available namespaces: {NAMESPACE_KEYS}",
+            f"Closest matches: {_get_close_matches(namespace_key, namespace_keys())}\n\n"
+            f"Available namespaces: {list(namespace_keys())}",
             file=sys.stderr,
         )
         sys.exit(1)
 
-    namespace = cache.get(namespace_key) if cache else get_namespace(namespace_key)
+    if cache is not None:
+        namespace = cache.get(namespace_key)
+    else:
+        namespace = get_namespace(namespace_key)
     if isinstance(namespace, ErrorLoadingNamespace):
         print(f'Error loading {namespace_key} namespace module.\n')
         print(namespace.longdescr)
         sys.exit(1)
 
-    if command_name not in namespace.commands:
+    if command_name not in namespace.command_specs:
+        commands = namespace.commands
         print(
             f"Error! Command '{command_name}' does not exist in namespace '{namespace_key}' - "
             f"{namespace.descr}.\nClosest matches: "
-            f"{_get_close_matches(command_name, namespace.commands)}\n\nAvailable commands: "
-            f"{namespace.commands}\nSee `clr help {namespace_key}` for details.",
+            f"{_get_close_matches(command_name, commands)}\n\nAvailable commands: "
+            f"{list(commands)}\nSee `clr help {namespace_key}` for details.",
             file=sys.stderr,
         )
         sys.exit(1)
@@ -147,16 +290,10 @@ def _get_arg_type(param):
     TODO(michael.cusack): Also look at other type annotations?
     """
 
-    # Special support for type hinted Enum params.
+    # Special support for type hinted Enum params. A partial rather than a closure so it can
+    # be pickled along with the CommandSpec.
     if _is_enum_param(param):
-
-        def enum_parser(arg):
-            arg = arg.upper()
-            options = set(key.upper() for key in param.annotation.__members__)
-            assert arg in options, f"Arg ({param.name}={arg}) must be one of {options}."
-            return param.annotation.__members__[arg]
-
-        return enum_parser
+        return partial(_parse_enum, param.annotation, param.name)
 
     # Infer from type of default
     if param.default not in (Signature.empty, None):
@@ -170,86 +307,205 @@ def _get_arg_type(param):
         return default_type
 
 
-class NoneIgnoringArgparseDestination(argparse.Namespace):
-    """argparse destination namespace that ignores attributes changed to None.
+def _parse_enum(enum_cls, name, arg):
+    """Parses a command line arg into a member of enum_cls."""
+    arg = arg.upper()
+    options = set(key.upper() for key in enum_cls.__members__)
+    assert arg in options, f"Arg ({name}={arg}) must be one of {options}."
+    return enum_cls.__members__[arg]
 
-    In order to allow arguments to be specified as positional or named (--a A) we add two mutally
-    exlusive arguments with the same dest. The positional one has nargs=? which means when it is
-    left out it will always set None. In practice there is no way to explicitly and purposfully set
-    an argument to None, so we simply ignore attempts to set an attribute to None if is currently
-    has a value. We are relying on the callable's Signature's BoundArguments to apply defaults, not
-    argparse.
+
+def _help_width():
+    """Width argparse would format help to in the current terminal."""
+    import shutil
+
+    return shutil.get_terminal_size().columns - 2
+
+
+@lru_cache(maxsize=None)
+def _help_formatter_class(width):
+    """Returns a help formatter factory for a fixed width.
+
+    Otherwise argparse looks up the terminal size every time it formats help.
     """
+    return partial(argparse.RawDescriptionHelpFormatter, width=width)
 
-    def __setattr__(self, attr, value):
-        if value is not None:
-            super().__setattr__(attr, value)
 
+@dataclass(frozen=True, **_SLOTS)
+class ParamInfo:
+    """What argument parsing and completion need to know about a command parameter.
 
-@dataclass(frozen=True)
+    Computed once from the inspect.Parameter so the hot paths don't re-introspect.
+    """
+
+    name: str
+    kind: inspect._ParameterKind
+    required: bool
+    # The default as shown in help, None for required params.
+    default_text: Optional[str]
+    # repr() of the default for error messages, None for required params.
+    default_repr: Optional[str]
+    # Type/parser for the arg, None for plain strings. See _get_arg_type.
+    arg_type: Optional[Callable]
+    # Set when the param's default has an unsupported type. Raised when the command's parser
+    # is built, so that one bad command doesn't break loading the rest of its namespace.
+    arg_type_error: Optional[str]
+    is_bool: bool
+    is_numerical: bool
+    # Member names when the param is annotated with an Enum subclass.
+    enum_names: Optional[tuple]
+
+    @staticmethod
+    def create(param):
+        required = param.default == Signature.empty
+        default_text = default_repr = None
+        if not required:
+            default_repr = repr(param.default)
+        if isinstance(param.default, Enum):
+            default_text = param.default.name.lower()
+        elif not required:
+            default_text = str(param.default)
+        enum_names = None
+        if _is_enum_param(param):
+            enum_names = tuple(member.name for member in param.annotation)
+        arg_type = arg_type_error = None
+        try:
+            arg_type = _get_arg_type(param)
+        except AssertionError as error:
+            arg_type_error = str(error)
+        return ParamInfo(
+            param.name,
+            param.kind,
+            required,
+            default_text,
+            default_repr,
+            arg_type,
+            arg_type_error,
+            type(param.default) == bool,
+            type(param.default) in (int, float),
+            enum_names,
+        )
+
+
+@dataclass(frozen=True, **_SLOTS)
 class CommandSpec:
     """Pickle-able specification of a command."""
 
     docstr: str
-    signature: Signature
+    # None for specs from NamespaceCache, see for_cache.
+    signature: Optional[Signature]
+    params: tuple
+    # Index of the VAR_POSITIONAL (*args) param in params, if there is one.
+    var_positional_index: Optional[int]
 
+    def for_cache(self):
+        """Returns a copy of the spec that can be unpickled without importing the namespace module.
 
-@dataclass
+        The signature and enum arg parsers can reference classes defined in the module. Cached
+        specs are only used for help and completion, which don't need either.
+        """
+        return CommandSpec(
+            self.docstr,
+            None,
+            tuple(
+                param if param.enum_names is None else replace(param, arg_type=None)
+                for param in self.params
+            ),
+            self.var_positional_index,
+        )
+
+
+# (CommandSpec, ArgumentParser) pairs keyed by (namespace key, command name). Shared by
+# Namespaces and NamespaceCacheEntries, which can't hold them as they are pickled. The spec
+# is kept to check the parser was built from the same spec object, rather than hashing it.
+_argument_parsers: Dict[tuple, tuple] = {}
+
+
+@dataclass(**_SLOTS)
 class Namespace:
     """clr command namespace."""
 
     key: str
     descr: str
     longdescr: str
-    command_specs: Dict[str, CommandSpec]
+    command_specs: Mapping[str, CommandSpec]
     command_callables: Dict[str, Callable]
     instance: Any
+    # Sorted tuple of command names in this namespace.
+    commands: tuple = field(init=False, repr=False)
 
-    @property
-    def commands(self):
-        """Sorted list of command names in this namespace."""
-        return sorted(self.command_specs.keys())
+    def __post_init__(self):
+        self.commands = tuple(sorted(self.command_specs))
 
     def parse_args(self, command_name, argv):
         """Parse args for the given command."""
 
-        signature = self.command_specs[command_name].signature
-        parameters = signature.parameters.values()
-        has_var_positional = any(p.kind == p.VAR_POSITIONAL for p in parameters)
+        spec = self.command_specs[command_name]
 
         # Parse the command line arguments, starting after command name.
-        parsed = NoneIgnoringArgparseDestination()
-        self.argument_parser(command_name).parse_args(argv, namespace=parsed)
-
-        # Turn parsed args into something we can pass to signature.bind.
+        parsed = self.argument_parser(command_name).parse_args(argv)
+        # Merge the named (--arg) and positional dests of each param, see argument_parser. In
+        # practice there is no way to explicitly and purposfully set an argument to None, so
+        # None means it was left out.
+        values = {
+            dest.lstrip("-"): value
+            for dest, value in vars(parsed).items()
+            if value is not None
+        }
+
+        # Turn parsed args into something we can pass to signature.bind. Params before a
+        # VAR_POSITIONAL param have to be passed positionally.
         args = []
-        kwargs = {}
-
-        # Track whether the current param is before a VAR_POSITIONAL param.
-        before_var_positional = has_var_positional
-
-        for param in parameters:
-            if param.kind == param.VAR_POSITIONAL:
-                args.extend(getattr(parsed, param.name))
-                before_var_positional = False
-            elif before_var_positional:
-                args.append(getattr(parsed, param.name))
-            elif hasattr(parsed, param.name):
-                # BoundArguments will apply the defaults.
-                kwargs[param.name] = getattr(parsed, param.name)
+        named_params = spec.params
+        index = spec.var_positional_index
+        if index is not None:
+            args.extend(values[param.name] for param in spec.params[:index])
+            args.extend(values[spec.params[index].name])
+            named_params = spec.params[index + 1 :]
+        # BoundArguments will apply the defaults.
+        kwargs = {
+            param.name: values[param.name]
+            for param in named_params
+            if param.name in values
+        }
 
         # Ensure the signature is valid and applies default. Could use argparse to do more of this,
         # but adds correctness guarantees and gives a nice error message when something is wrong.
-        bound_args = signature.bind(*args, **kwargs)
+        bound_args = spec.signature.bind(*args, **kwargs)
         bound_args.apply_defaults()
         return bound_args
 
+    def format_help(self, command_name, width):
+        """Returns the help text for a command, formatted to the given width."""
+        from copy import copy
+
+        # A shallow copy so the formatter isn't changed on the shared parser.
+        parser = copy(self.argument_parser(command_name))
+        parser.formatter_class = _help_formatter_class(width)
+        return parser.format_help()
+
     def argument_parser(self, command_name):
+        """Returns the ArgumentParser for command, built once per process."""
+        spec = self.command_specs[command_name]
+        cached_spec, parser = _argument_parsers.get(
+            (self.key, command_name), (None, None)
+        )
+        if cached_spec is not spec:
+            parser = self._build_argument_parser(command_name)
+            _argument_parsers[self.key, command_name] = (spec, parser)
+        return parser
+
+    def _build_argument_parser(self, command_name):
         """Returns an ArgumentParser matching the signature of command.
 
         Defaults are not specified in the parser spec because they are applied via the signature
         binding.
 
+        In order to allow arguments to be specified as positional or named (--a A) we add two
+        mutally exclusive arguments. The positional one has nargs=? which means when it is left out
+        it will always set None, so the named one is given its own dest (--a) rather than sharing
+        one. parse_args merges the two.
+
         General approach is to allow as much flexibility for how arguements are specificied as
         possible while maintaining 100% compatibility with legacy arg parsing (if it used to work it
         should continue to work). The original approach had a stricter seperation between positional
@@ -301,7 +557,7 @@ class Namespace:
         clr argtest 1 2 --c=a (c must be an int)
         """
         spec = self.command_specs[command_name]
-        parameters = spec.signature.parameters.values()
+        parameters = spec.params
         parser = argparse.ArgumentParser(
             prog=f"clr {self.key}:{command_name}",
             description=spec.docstr,
@@ -311,25 +567,30 @@ class Namespace:
 
         # Track whether there is a var positional/vararg/*args parameter. If so, less flexibility on
         # positional vs named.
-        has_var_positional = any(p.kind == p.VAR_POSITIONAL for p in parameters)
+        has_var_positional = spec.var_positional_index is not None
         # We are before a var_positional if there is a var_positional.
         before_var_positional = has_var_positional
 
         # Add argument(s) to the parser for each param in the cmd signature.
         for param in parameters:
             name = param.name
-            required = param.default == Signature.empty
-            arg_type = _get_arg_type(param)
+            required = param.required
+            arg_type = param.arg_type
+            if param.arg_type_error is not None:
+                raise AssertionError(param.arg_type_error)
 
-            if before_var_positional and param.kind == param.VAR_POSITIONAL:
+            if before_var_positional and param.kind == Parameter.VAR_POSITIONAL:
                 before_var_positional = False
             if before_var_positional and not required:
                 raise AssertionError(
-                    f"Can not have optional arg ({param}) before a *vararg in {self.key}.cmd_{command_name}"
+                    f"Can not have optional arg ({name}={param.default_repr}) before a *vararg in {self.key}.cmd_{command_name}"
                 )
 
             if required:
-                if param.kind in (param.POSITIONAL_ONLY, param.POSITIONAL_OR_KEYWORD):
+                if param.kind in (
+                    Parameter.POSITIONAL_ONLY,
+                    Parameter.POSITIONAL_OR_KEYWORD,
+                ):
                     if has_var_positional:
                         parser.add_argument(name, type=str, help=f"Required.")
                     else:
@@ -338,6 +599,8 @@ class Namespace:
                         group = parser.add_mutually_exclusive_group(required=True)
                         group.add_argument(
                             f"--{name}",
+                            dest=f"--{name}",
+                            metavar=name.upper(),
                             type=arg_type,
                             help=f"Required. Can also be specified with positional arg {name}.",
                         )
@@ -347,7 +610,7 @@ class Namespace:
                             type=arg_type,
                             help=f"Required. Can also be specified with --{name}.",
                         )
-                elif param.kind == param.VAR_POSITIONAL:
+                elif param.kind == Parameter.VAR_POSITIONAL:
                     # Vararg (*args) param. There will only ever be one of these
                     # it will be at the end of the positional args.
                     if self.key == "system" and command_name == "smart_complete":
@@ -365,16 +628,16 @@ class Namespace:
                 # Args with defaults can be refered to by name and are optional.
 
                 # No support for kwargs.
-                if param.kind not in (param.POSITIONAL_OR_KEYWORD, param.KEYWORD_ONLY):
+                if param.kind not in (
+                    Parameter.POSITIONAL_OR_KEYWORD,
+                    Parameter.KEYWORD_ONLY,
+                ):
                     raise AssertionError(
                         f"Unexpected kwarg **{name} in {command_name}."
                     )
 
                 # Put the default in the help text to clarify behavior when it is not specified.
-                default_text = str(param.default)
-                if isinstance(param.default, Enum):
-                    default_text = param.default.name.lower()
-                help_text = f"Optional. Defaults to {name}='{default_text}'."
+                help_text = f"Optional. Defaults to {name}='{param.default_text}'."
 
                 if arg_type == bool:
                     # Add both the --arg and --noarg options, but make them mutally exclusive.
@@ -397,7 +660,7 @@ class Namespace:
                         parser.add_argument(f"--{name}", type=arg_type, help=help_text)
                     else:
                         # Add both as optional (nargs=?) positional and named (--arg) for
-                        # flexibility. Mutually exclusive and have the same dest.
+                        # flexibility. Mutually exclusive.
                         group = parser.add_mutually_exclusive_group()
                         group.add_argument(
                             name,
@@ -407,6 +670,8 @@ class Namespace:
                         )
                         group.add_argument(
                             f"--{name}",
+                            dest=f"--{name}",
+                            metavar=name.upper(),
                             type=arg_type,
                             help=f"{help_text} Can also be specified with positional arg {name}.",
                         )
@@ -432,16 +697,18 @@ class ErrorLoadingNamespace:
     def descr(self):
         return f"ERROR Could not load. See `clr help {self.key}`"
 
-    @property
+    @cached_property
     def longdescr(self):
+        import traceback
+
         tb = "".join(traceback.TracebackException.from_exception(self.error).format())
         return (
-            f"Error importing module '{NAMESPACE_MODULE_PATHS[self.key]}' for namespace "
+            f"Error importing module '{namespace_module_paths()[self.key]}' for namespace "
             f"'{self.key}':\n\n{type(self.error).__name__} {self.error}\n{tb}"
         )
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, **_SLOTS)
 class NamespaceCacheEntry:
     """Picke-able subset of Namespace for NamespaceCache."""
 
@@ -449,17 +716,137 @@ class NamespaceCacheEntry:
     descr: str
     longdescr: str
     command_specs: dict
+    # Source file of the namespace module and its mtime when the entry was created.
+    source_file: Optional[str]
+    source_mtime: Optional[float]
+    # Rendered help texts keyed by (command name, width), for a single width. Filled in by
+    # NamespaceCache as help is printed.
+    help_texts: dict = field(default_factory=dict, compare=False, repr=False)
+    # Sorted tuple of command names in this namespace.
+    commands: tuple = field(init=False, repr=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "commands", tuple(sorted(self.command_specs)))
 
     @staticmethod
     def create(namespace):
+        module = sys.modules.get(namespace_module_paths().get(namespace.key))
+        source_file = getattr(module, "__file__", None)
         return NamespaceCacheEntry(
-            namespace.key, namespace.descr, namespace.longdescr, namespace.command_specs
+            namespace.key,
+            namespace.descr,
+            namespace.longdescr,
+            {
+                command_name: spec.for_cache()
+                for command_name, spec in namespace.command_specs.items()
+            },
+            source_file,
+            _get_mtime(source_file),
         )
 
+    def is_stale(self):
+        """Whether the namespace module has changed since this entry was created."""
+        return (
+            self.source_file is not None
+            and _get_mtime(self.source_file) != self.source_mtime
+        )
+
+
+def _get_mtime(path):
+    """Returns the modification time of path, or None if it can't be read."""
+    if path is None:
+        return None
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
 
 # Steal some functionality.
-NamespaceCacheEntry.commands = Namespace.commands
+NamespaceCacheEntry.format_help = Namespace.format_help
 NamespaceCacheEntry.argument_parser = Namespace.argument_parser
+NamespaceCacheEntry._build_argument_parser = Namespace._build_argument_parser
+
+
+def _find_module_source(module_path):
+    """Returns the source file of a module on sys.path without importing it or its parents."""
+    module = sys.modules.get(module_path)
+    if module is not None:
+        return getattr(module, "__file__", None)
+    relative_path = module_path.replace(".", os.sep)
+    for search_path in sys.path:
+        for candidate in (
+            f"{relative_path}.py",
+            os.path.join(relative_path, "__init__.py"),
+        ):
+            source_file = os.path.join(search_path or os.getcwd(), candidate)
+            if os.path.isfile(source_file):
+                return source_file
+    return None
+
+
+def _scan_command_names(module_path):
+    """Reads the command names of a namespace module from its source without importing it.
+
+    Only understands the common layout where the module sets `COMMANDS = SomeClass()` and
+    SomeClass is defined in the same module without base classes. Returns None if the module
+    doesn't look like that and has to be imported instead.
+    """
+    import ast
+
+    source_file = _find_module_source(module_path)
+    if source_file is None or not source_file.endswith(".py"):
+        return None
+    try:
+        with open(source_file, "rb") as f:
+            tree = ast.parse(f.read(), source_file)
+    except (OSError, SyntaxError, ValueError):
+        return None
+
+    class_name = None
+    for node in tree.body:
+        if (
+            isinstance(node, ast.Assign)
+            and any(
+                isinstance(t, ast.Name) and t.id == "COMMANDS" for t in node.targets
+            )
+            and isinstance(node.value, ast.Call)
+            and isinstance(node.value.func, ast.Name)
+        ):
+            class_name = node.value.func.id
+    class_defs = [
+        node
+        for node in tree.body
+        if isinstance(node, ast.ClassDef) and node.name == class_name
+    ]
+    if len(class_defs) != 1:
+        return None
+    class_def = class_defs[0]
+    if class_def.decorator_list or class_def.keywords:
+        return None
+    if any(not (isinstance(b, ast.Name) and b.id == "object") for b in class_def.bases):
+        return None
+    command_names = []
+    for node in class_def.body:
+        if isinstance(node, ast.FunctionDef) and not node.decorator_list:
+            if node.name.startswith("cmd_"):
+                command_names.append(sys.intern(node.name[4:]))
+            continue
+        # Decorated or async commands, and ones assigned or imported in the class body, might
+        # not end up as plain methods. Leave those to the import.
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound_names = [node.name]
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            bound_names = [alias.asname or alias.name for alias in node.names]
+        else:
+            bound_names = [
+                name.id
+                for name in ast.walk(node)
+                if isinstance(name, ast.Name) and isinstance(name.ctx, ast.Store)
+            ]
+        if any(name.startswith("cmd_") for name in bound_names):
+            return None
+    return tuple(sorted(command_names))
 
 
 class NamespaceCache:
@@ -477,40 +864,102 @@ class NamespaceCache:
         # this file is easily regeneratable in the event of a system restart, but should
         # be left behind after the process is complete for subsequent clr calls to find.
         tmpdir = os.environ.get("TMPDIR", "/tmp")
-        self.cache_fn = os.path.join(tmpdir, "clr_command_cache")
+        # The clr version is part of the name so that upgrades don't read entries in an
+        # old format.
+        self.cache_fn = os.path.join(tmpdir, f"clr_command_cache_{__version__}.pickle")
         # Lazily load the cache file so that clr calls that don't need to won't hit the
         # disk.
         self.cache = None
+        # Keys of entries added or updated by this process. They are written to disk once,
+        # when the process exits.
+        self._changed_keys = set()
 
     def get(self, namespace_key):
         # Don't cache the system namespace. It is already loaded.
         if namespace_key == "system":
             return get_namespace("system")
-        # Return from cache if present.
+        # Return from cache if present and the namespace module hasn't been modified
+        # since. Otherwise reload just this namespace.
         self._load_cache_if_needed()
-        if namespace_key in self.cache:
-            return self.cache[namespace_key]
+        entry = self.cache.get(namespace_key)
+        if entry is not None and not entry.is_stale():
+            return entry
         return self._load_and_sync_entry(namespace_key)
 
+    def get_many(self, namespace_keys):
+        """Like get() for each key, but imports the namespaces that aren't cached concurrently."""
+        self._load_cache_if_needed()
+        missing = []
+        for namespace_key in namespace_keys:
+            entry = self.cache.get(namespace_key)
+            if namespace_key != "system" and (entry is None or entry.is_stale()):
+                missing.append(namespace_key)
+        get_namespaces(missing)
+        return [self.get(namespace_key) for namespace_key in namespace_keys]
+
+    def get_commands(self, namespace_key):
+        """Sorted tuple of command names in a namespace.
+
+        On a cache miss, tries reading the names from the namespace module's source before falling
+        back to importing it. Completing command names shouldn't need to import the world.
+        """
+        if namespace_key != "system":
+            self._load_cache_if_needed()
+            entry = self.cache.get(namespace_key)
+            if entry is not None and not entry.is_stale():
+                return entry.commands
+            commands = _scan_command_names(namespace_module_paths()[namespace_key])
+            if commands is not None:
+                return commands
+        return self.get(namespace_key).commands
+
+    def format_help(self, namespace_key, command_name, width):
+        """Returns the help text for a command, formatted to the given width.
+
+        Rendered help is stored in the cache entry so that repeated `clr help` calls don't need to
+        rebuild the command's ArgumentParser.
+        """
+        namespace = self.get(namespace_key)
+        help_texts = getattr(namespace, "help_texts", None)
+        if help_texts is None:
+            # Not a cache entry.
+            return namespace.format_help(command_name, width)
+        help_key = (command_name, width)
+        if help_key not in help_texts:
+            # Only keep help for the most recent width. The whole cache file is read by every
+            # completion call, so it shouldn't grow with each terminal size used.
+            if any(cached_width != width for _, cached_width in help_texts):
+                help_texts.clear()
+            help_texts[help_key] = namespace.format_help(command_name, width)
+            self._save_at_exit(namespace_key)
+        return help_texts[help_key]
+
     def clear(self):
-        # Create a new empty db.
-        with shelve.open(self.cache_fn, flag="n"):
+        self.cache = {}
+        self._changed_keys.clear()
+        try:
+            os.remove(self.cache_fn)
+        except FileNotFoundError:
             pass
 
     def _load_cache_if_needed(self):
         if self.cache is not None:
             # Already loaded.
             return
+        self.cache = self._read()
+
+    def _read(self):
+        import pickle
+
         try:
-            # Cache is stored on disk as a shelve, but loaded into memory and then
-            # closed right away so that multiple processes are unlikely to conflict
-            # trying to access it.
-            with shelve.open(self.cache_fn) as cache_shelve:
-                self.cache = dict(cache_shelve)
+            # The whole cache is stored on disk as a single pickled dict so loading it
+            # is one read.
+            with open(self.cache_fn, "rb") as cache_file:
+                return pickle.load(cache_file)
         except Exception:
             # Caching is considered best effort and fails silently. Can always load the
             # module, this is just slower.
-            self.cache = {}
+            return {}
 
     def _load_and_sync_entry(self, namespace_key):
         namespace = get_namespace(namespace_key)
@@ -520,15 +969,38 @@ class NamespaceCache:
 
         entry = NamespaceCacheEntry.create(namespace)
         self.cache[namespace_key] = entry
+        self._save_at_exit(namespace_key)
+        return entry
 
-        # Try to save the entry to disk. Fail silently.
+    def _save_at_exit(self, namespace_key):
+        """Save the entry to disk when the process exits, along with any other changes."""
+        if not self._changed_keys:
+            atexit.register(self._save)
+        self._changed_keys.add(namespace_key)
+
+    def _save(self):
+        """Try to save the cache to disk. Fail silently.
+
+        Only the entries this process changed are written, merged into what is on disk
+        now, so entries other clr processes saved in the meantime are kept. Written to a
+        temp file and then renamed over the cache file so that other clr processes never
+        see a partially written cache.
+        """
+        import pickle
+
+        cache = self._read()
+        for namespace_key in self._changed_keys:
+            cache[namespace_key] = self.cache[namespace_key]
+        tmp_fn = f"{self.cache_fn}.{os.getpid()}.tmp"
         try:
-            with shelve.open(self.cache_fn) as cache_shelve:
-                cache_shelve[namespace_key] = entry
+            with open(tmp_fn, "wb") as cache_file:
+                pickle.dump(cache, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_fn, self.cache_fn)
         except Exception:
-            pass
-
-        return entry
+            try:
+                os.remove(tmp_fn)
+            except OSError:
+                pass
 
 
 class System:
@@ -541,7 +1013,10 @@ class System:
 
     descr = "clr built-in commands"
 
-    cache = NamespaceCache()
+    @cached_property
+    def cache(self):
+        # Created on first use rather than when this module is imported.
+        return NamespaceCache()
 
     def cmd_clear_cache(self):
         """Clear clr's cache.
@@ -549,20 +1024,24 @@ class System:
         clr caches command specs to disk to speed up help and completions.
         Run this to clear the cache if your results are stale."""
         self.cache.clear()
+        get_namespace.cache_clear()
+
+    def cmd_warm_cache(self):
+        """Fill clr's cache for all namespaces.
+
+        Namespaces that aren't cached (or have changed) are imported concurrently. Afterwards help
+        and completions don't need to import anything."""
+        self.cache.get_many(namespace_keys())
 
     def cmd_complete_command(self, query=""):
         """Completion results for first arg to clr."""
 
-        results = []
         if ":" not in query:
-            # Suffix system commands with a space.
-            results.extend(f"{c} " for c in self.cache.get("system").commands)
-            # Suffix namespaces with a :.
-            results.extend(f"{k}:" for k in NAMESPACE_KEYS)
+            results = _with_prefix(_top_level_completions(), query)
         else:
-            namespace_key, _ = query.split(":", 1)
-            namespace = self.cache.get(namespace_key)
-            results.extend(f"{namespace_key}:{c} " for c in namespace.commands)
+            namespace_key, _, partial = query.partition(":")
+            commands = self.cache.get_commands(namespace_key)
+            results = [f"{namespace_key}:{c} " for c in _with_prefix(commands, partial)]
         print_for_complete(query, results, add_space=False)
 
     def cmd_complete_arg(self, command_name, partial="", bools_only=False):
@@ -574,17 +1053,14 @@ class System:
         namespace = self.cache.get(namespace_key)
 
         options = []
-        for param in namespace.command_specs[
-            command_name
-        ].signature.parameters.values():
-            is_bool = type(param.default) == bool
-            if not bools_only or is_bool:
+        for param in namespace.command_specs[command_name].params:
+            if not bools_only or param.is_bool:
                 options.append(f"--{param.name}")
-            if is_bool:
+            if param.is_bool:
                 options.append(f"--no{param.name}")
         # partial is prepended with a space to stop argparse from parsing it
         partial = partial.strip()
-        print_for_complete(partial, results)
+        print_for_complete(partial, options)
 
     def cmd_smart_complete(self, *existing_args):
         """Smart/opinionated completion.
@@ -615,14 +1091,15 @@ class System:
         def is_positional(arg):
             return not arg.startswith("--")
 
-        existing_positional_args = len(list(takewhile(is_positional, previous_args)))
+        existing_positional_args = 0
+        for arg in previous_args:
+            if not is_positional(arg):
+                break
+            existing_positional_args += 1
+        previous_arg_set = set(previous_args)
 
         namespace_key, command_name = resolve_command(command_name, cache=self.cache)
-        parameters = (
-            self.cache.get(namespace_key)
-            .command_specs[command_name]
-            .signature.parameters.values()
-        )
+        parameters = self.cache.get(namespace_key).command_specs[command_name].params
 
         # Scan over all parameters for the command to build up data for the following purposes:
         # Will suggest the first missing required arg if there is one.
@@ -633,29 +1110,30 @@ class System:
         boolean_options = set()
         # No filename completion for numberical args.
         numerical_options = set()
-        # Mapping from enum options to their class,
+        # Mapping from enum options to their member names.
         enum_options = {}
         # Required args don't have named flags if there is a var positional.
         has_var_positional = False
         for param_index, param in enumerate(parameters):
-            if param.kind == param.VAR_POSITIONAL:
+            if param.kind == Parameter.VAR_POSITIONAL:
                 has_var_positional = True
                 continue
 
-            required = param.default == Signature.empty
-            missing_args = missing_required_args if required else missing_optional_args
+            missing_args = (
+                missing_required_args if param.required else missing_optional_args
+            )
             arg_names = [f"--{param.name}"]
 
-            if type(param.default) == bool:
+            if param.is_bool:
                 arg_names.append(f"--no{param.name}")
                 boolean_options.update(arg_names)
-            elif type(param.default) in (int, float):
+            elif param.is_numerical:
                 numerical_options.update(arg_names)
-            elif _is_enum_param(param):
-                enum_options[arg_names[0]] = param.annotation
+            elif param.enum_names is not None:
+                enum_options[arg_names[0]] = param.enum_names
 
             present_positionally = existing_positional_args > param_index
-            present_named = any(a in previous_args for a in arg_names)
+            present_named = any(a in previous_arg_set for a in arg_names)
             if not present_positionally and not present_named:
                 missing_args.extend(arg_names)
 
@@ -670,9 +1148,13 @@ class System:
                 return
             if previous_args[-1] in enum_options:
                 # Suggest all enum values.
-                for value in enum_options[previous_args[-1]]:
-                    if value.name.startswith(current_arg.upper()):
-                        print(f"{value.name.lower()} ")
+                sys.stdout.write(
+                    "".join(
+                        f"{value_name.lower()} \n"
+                        for value_name in enum_options[previous_args[-1]]
+                        if value_name.startswith(current_arg.upper())
+                    )
+                )
                 return
             # Return with exit code 2 to indicate to the shell that standard
             # file/dir completion is desired.
@@ -699,20 +1181,32 @@ class System:
         if has_var_positional:
             return 2
 
-    def cmd_profile_imports(self, *namespaces):
-        """Prints some debugging information about how long it takes to import clr namespaces."""
+    def cmd_profile_imports(self, *namespaces, parallel=False):
+        """Prints some debugging information about how long it takes to import clr namespaces.
+
+        With --parallel the namespaces are imported concurrently. The total is faster, but each
+        namespace's time also includes waiting on imports it shares with the others."""
         if not namespaces:
-            namespaces = NAMESPACE_KEYS
-        results = {}
-        for index, key in enumerate(namespaces):
-            start_time = time.time()
+            namespaces = namespace_keys()
+
+        def time_import(key):
+            start_time = time.perf_counter_ns()
             get_namespace(key)
-            results[f"#{index + 1}-{key}"] = time.time() - start_time
+            return time.perf_counter_ns() - start_time
+
+        if parallel:
+            durations = _map_concurrently(time_import, namespaces)
+        else:
+            durations = [time_import(key) for key in namespaces]
+        results = {
+            f"#{index + 1}-{key}": duration
+            for index, (key, duration) in enumerate(zip(namespaces, durations))
+        }
 
         print(
             "\n".join(
-                f"{k}: {int(1000*v)}"
-                for k, v in sorted(results.items(), key=lambda i: i[1])
+                f"{k}: {v // 1_000_000}"
+                for k, v in sorted(results.items(), key=itemgetter(1))
             )
         )
 
@@ -731,27 +1225,28 @@ class System:
         Prints help for a command.
         """
         if not query:
-            print("Available namespaces")
-            for namespace_key in NAMESPACE_KEYS:
-                print(
-                    " ",
-                    namespace_key.ljust(20),
-                    "-",
-                    self.cache.get(namespace_key).descr,
-                )
+            namespaces = self.cache.get_many(namespace_keys())
+            output = ["Available namespaces\n"]
+            for namespace_key, namespace in zip(namespace_keys(), namespaces):
+                output.append(f"  {namespace_key.ljust(20)} - {namespace.descr}\n")
+            _write_output("".join(output))
             return
 
         # If they passed just one arg and it is a namespace key, print help for the full namespace.
         if query.endswith(":"):
             query = query[:-1]
-        if query in NAMESPACE_KEYS and not query2:
+        if query in _namespace_key_set() and not query2:
             namespace = self.cache.get(query)
-            print(f"{query} - {namespace.longdescr}\n")
+            output = [f"{query} - {namespace.longdescr}\n\n"]
             for command in namespace.commands:
-                print(f"  clr {query}:{command}")
+                output.append(f"  clr {query}:{command}\n")
+            # Look up the terminal width once rather than once per command.
+            width = _help_width()
             for command in namespace.commands:
-                print("-" * 80)
-                self.print_help_for_command(query, command)
+                output.append("-" * 80 + "\n")
+                output.append(self.cache.format_help(query, command, width))
+            # Written all at once rather than a line at a time.
+            _write_output("".join(output))
             return
 
         if query2:
@@ -759,12 +1254,10 @@ class System:
         namespace_key, command_name = resolve_command(query, cache=self.cache)
         self.print_help_for_command(namespace_key, command_name)
 
-    def print_help_for_command(self, namespace, command):
-        try:
-            self.cache.get(namespace).argument_parser(command).print_help()
-        except BrokenPipeError:
-            # Less noisy if help is piped to `head`, etc.
-            pass
+    def print_help_for_command(self, namespace, command, width=None):
+        if width is None:
+            width = _help_width()
+        _write_output(self.cache.format_help(namespace, command, width))
 
     def cmd_argtest(self, a, b, c=4, d=None, e=False, f=True):
         """For testing arg parsing."""
@@ -775,10 +1268,33 @@ class System:
         print(f"a={a} b={b} c={c} d={d} e={e} f={f} g={g}")
 
 
+# Names of the system commands, known without loading the system namespace.
+_SYSTEM_COMMANDS = frozenset(
+    name[4:] for name in vars(System) if name.startswith("cmd_")
+)
+
+
+@lru_cache(maxsize=None)
+def _top_level_completions():
+    """Sorted tuple of completions for the first arg to clr."""
+    # Suffix system commands with a space and namespaces with a :.
+    completions = [f"{c} " for c in _SYSTEM_COMMANDS]
+    completions.extend(f"{k}:" for k in namespace_keys())
+    return tuple(sorted(completions))
+
+
+def _write_output(text):
+    try:
+        sys.stdout.write(text)
+    except BrokenPipeError:
+        # Less noisy if help is piped to `head`, etc.
+        pass
+
+
 def print_for_complete(current, options, add_space=True):
     options = [o for o in options if o.startswith(current)]
     if not options:
         return
     if add_space:
         options = [f"{o} " for o in options]
-    print("\n".join(options), end="")
+    sys.stdout.write("\n".join(options))
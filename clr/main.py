@@ -1,9 +1,7 @@
 import sys
 import os
 import getpass
-import beeline
 import time
-import traceback
 import atexit
 from contextlib import contextmanager
 from .commands import resolve_command, get_namespace
@@ -36,6 +34,9 @@ def send_to_honeycomb():
         if env.get("honeycomb") is None:
             return
 
+        # Imported here so it is only paid for when honeycomb is configured.
+        import beeline
+
         beeline.init(
             writekey=env.honeycomb.writekey,
             dataset="clr",
@@ -56,6 +57,8 @@ def send_to_honeycomb():
         beeline.close()
     except:
         if DEBUG_MODE:
+            import traceback
+
             print("Failed to initialize beeline.", file=sys.stderr)
             print(traceback.format_exc(), file=sys.stderr)
 
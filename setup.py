@@ -20,6 +20,10 @@ setup(
         "console_scripts": ["clr = clr:main"],
     },
     install_requires=install_requirements,
+    extras_require={
+        # Faster suggestions for mistyped commands.
+        "fuzzy": ["rapidfuzz"],
+    },
     license="MIT",
     include_package_data=True,
     package_data={
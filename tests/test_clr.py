@@ -1,5 +1,12 @@
+import argparse
+import enum
+import os
+import pickle
+import sys
+
 import pytest
 import clr
+from clr import commands
 
 
 def test_argtest(capsys):
@@ -68,3 +75,274 @@ def test_argtest2(capsys):
         ["11", "2", "3", "4", "--g=ggg", "--e=eee"],
         "a=11 b=2 c=('3', '4') d=4 e=eee f=False g=ggg",
     )
+
+
+def test_namespace_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("TMPDIR", str(tmp_path))
+    system = commands.get_namespace("system")
+    # Stand in the system namespace for a namespace that would need importing.
+    monkeypatch.setattr(commands, "get_namespace", lambda key: system)
+
+    cache = commands.NamespaceCache()
+    assert cache.get("other").commands == system.commands
+    # Saved at exit.
+    assert not os.path.exists(cache.cache_fn)
+
+    # Saving keeps entries saved by other processes in the meantime.
+    another_cache = commands.NamespaceCache()
+    another_cache.get("another")
+    another_cache._save()
+    cache._save()
+
+    # A fresh cache is loaded from disk.
+    monkeypatch.setattr(commands, "get_namespace", None)
+    fresh_cache = commands.NamespaceCache()
+    assert fresh_cache.get("other").commands == system.commands
+    assert fresh_cache.get("another").commands == system.commands
+
+    cache.clear()
+    assert not os.path.exists(cache.cache_fn)
+
+
+@pytest.mark.parametrize("rapidfuzz", [True, False])
+def test_get_close_matches(rapidfuzz, monkeypatch):
+    if rapidfuzz:
+        pytest.importorskip("rapidfuzz")
+    else:
+        # Fall back to difflib.
+        monkeypatch.setitem(sys.modules, "rapidfuzz", None)
+    options = ("alpha", "beta", "betamax", "gamma")
+    assert commands._get_close_matches("", options) == []
+    assert commands._get_close_matches("bet", options) == ["beta", "betamax"]
+    assert commands._get_close_matches("gama", options)[0] == "gamma"
+    assert commands._get_close_matches("zzz", options) == []
+
+
+def test_scan_command_names(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / "scanned_commands.py").write_text(
+        "raise ImportError('should not be imported')\n"
+        "class Commands:\n"
+        "    descr = 'scanned'\n"
+        "    def cmd_b(self): pass\n"
+        "    def cmd_a(self, x): pass\n"
+        "    def helper(self): pass\n"
+        "COMMANDS = Commands()\n"
+    )
+    (tmp_path / "inherited_commands.py").write_text(
+        "from scanned_commands import Commands as Base\n"
+        "class Commands(Base): pass\n"
+        "COMMANDS = Commands()\n"
+    )
+    assert commands._scan_command_names("scanned_commands") == ("a", "b")
+    assert commands._scan_command_names("inherited_commands") is None
+    for command in (
+        "    @staticmethod\n    def cmd_decorated(): pass\n",
+        "    async def cmd_async(self): pass\n",
+        "    cmd_alias = cmd_plain\n",
+    ):
+        (tmp_path / "unscannable_commands.py").write_text(
+            "class Commands:\n"
+            "    def cmd_plain(self): pass\n"
+            f"{command}"
+            "COMMANDS = Commands()\n"
+        )
+        assert commands._scan_command_names("unscannable_commands") is None
+    assert commands._scan_command_names("missing_commands") is None
+
+
+def test_lazy_module_constants():
+    assert commands.NAMESPACE_KEYS == commands.namespace_keys()
+    assert "system" in commands.NAMESPACE_KEYS
+    assert commands.NAMESPACE_MODULE_PATHS is commands.namespace_module_paths()
+    with pytest.raises(AttributeError):
+        commands.NOT_A_CONSTANT
+
+
+def test_command_spec_params():
+    spec = commands.get_namespace("system").command_specs["argtest2"]
+    assert [p.name for p in spec.params] == list(spec.signature.parameters)
+    a, b, c, d, e, f, g = spec.params
+    assert a.required and a.arg_type is None
+    assert c.kind == c.kind.VAR_POSITIONAL
+    assert not d.required and d.is_numerical and d.arg_type is int
+    assert f.is_bool and f.arg_type is bool
+    assert g.arg_type is str and g.enum_names is None
+
+
+def test_argument_parser_reused():
+    system = commands.get_namespace("system")
+    parser = system.argument_parser("argtest")
+    assert system.argument_parser("argtest") is parser
+    assert system.argument_parser("argtest2") is not parser
+    # Formatting help at a fixed width doesn't change the shared parser.
+    system.format_help("argtest", 40)
+    assert parser.formatter_class is argparse.RawDescriptionHelpFormatter
+
+
+def test_complete_arg(capsys):
+    with pytest.raises(SystemExit) as e:
+        clr.main(["clr", "complete_arg", "argtest", " --n"])
+    assert e.value.code == 0
+    assert capsys.readouterr().out == "--noe \n--nof "
+
+
+def test_with_prefix():
+    options = ("alpha", "beta", "betamax", "gamma")
+    assert commands._with_prefix(options, "") == options
+    assert commands._with_prefix(options, "bet") == ("beta", "betamax")
+    assert commands._with_prefix(options, "betamax") == ("betamax",)
+    assert commands._with_prefix(options, "c") == ()
+    assert commands._with_prefix(options, "zzz") == ()
+
+
+class Color(enum.Enum):
+    RED = 1
+    GREEN = 2
+
+
+class EnumCommands:
+    def cmd_paint(self, color: Color = Color.RED):
+        pass
+
+
+def test_command_spec_for_cache():
+    spec = commands._get_command_spec(EnumCommands.cmd_paint)
+    (color,) = spec.params
+    assert color.arg_type("green") is Color.GREEN
+    assert color.default_text == "red"
+    assert color.enum_names == ("RED", "GREEN")
+
+    # Unpickling a cached spec must not need to import the module defining Color.
+    cached = spec.for_cache()
+    assert __name__.encode() not in pickle.dumps(cached)
+    assert pickle.loads(pickle.dumps(cached)).params[0].enum_names == ("RED", "GREEN")
+
+
+@pytest.fixture
+def namespace_modules(tmp_path, monkeypatch):
+    """Installs namespace modules written to tmp_path. Takes a dict of key to source."""
+    monkeypatch.setenv("TMPDIR", str(tmp_path))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    # Don't touch the real cache file.
+    system = commands.get_namespace("system")
+    monkeypatch.setattr(system.instance, "cache", commands.NamespaceCache())
+
+    def install(sources):
+        module_paths = {}
+        for key, source in sources.items():
+            module_path = f"{tmp_path.name}_{key}".replace("-", "_")
+            (tmp_path / f"{module_path}.py").write_text(source)
+            module_paths[key] = module_path
+        monkeypatch.setattr(commands, "namespace_module_paths", lambda: module_paths)
+        monkeypatch.setattr(
+            commands, "namespace_keys", lambda: tuple(sorted({"system", *module_paths}))
+        )
+        monkeypatch.setattr(
+            commands, "_namespace_key_set", lambda: frozenset({"system", *module_paths})
+        )
+
+    yield install
+    commands.get_namespace.cache_clear()
+
+
+def test_help_with_unsupported_default(namespace_modules, capsys):
+    namespace_modules(
+        {
+            "odd": "import datetime\n"
+            "class Commands:\n"
+            "    descr = 'has an odd command'\n"
+            "    def cmd_ok(self, x=1): pass\n"
+            "    def cmd_when(self, day=datetime.date(2020, 1, 1)): pass\n"
+            "COMMANDS = Commands()\n",
+            "plain": "class Commands:\n"
+            "    descr = 'plain'\n"
+            "    def cmd_a(self): pass\n"
+            "COMMANDS = Commands()\n",
+        }
+    )
+    with pytest.raises(SystemExit) as e:
+        clr.main(["clr", "help"])
+    assert e.value.code == 0
+    out = capsys.readouterr().out
+    assert "has an odd command" in out
+    assert "plain" in out
+
+    with pytest.raises(SystemExit) as e:
+        clr.main(["clr", "complete_arg", "odd:ok"])
+    assert e.value.code == 0
+    assert capsys.readouterr().out == "--x "
+
+    # The bad command itself still fails when its parser is built.
+    with pytest.raises(AssertionError, match="Unexpected arg type for \\(day\\)"):
+        clr.main(["clr", "odd:when"])
+
+
+def test_help_with_main_thread_only_namespace(namespace_modules, capsys):
+    namespace_modules(
+        {
+            key: "import signal\n"
+            "signal.signal(signal.SIGUSR1, signal.SIG_DFL)\n"
+            "class Commands:\n"
+            f"    descr = 'signal handler {key}'\n"
+            "COMMANDS = Commands()\n"
+            for key in ("sig1", "sig2")
+        }
+    )
+    with pytest.raises(SystemExit) as e:
+        clr.main(["clr", "help"])
+    assert e.value.code == 0
+    out = capsys.readouterr().out
+    assert "signal handler sig1" in out
+    assert "signal handler sig2" in out
+    assert "ERROR" not in out
+
+
+def test_help_texts_keep_one_width(tmp_path, monkeypatch):
+    monkeypatch.setenv("TMPDIR", str(tmp_path))
+    system = commands.get_namespace("system")
+    monkeypatch.setattr(commands, "get_namespace", lambda key: system)
+
+    cache = commands.NamespaceCache()
+    cache.format_help("other", "argtest", 80)
+    cache.format_help("other", "argtest2", 80)
+    help_texts = cache.get("other").help_texts
+    assert set(help_texts) == {("argtest", 80), ("argtest2", 80)}
+    cache.format_help("other", "argtest", 100)
+    assert set(help_texts) == {("argtest", 100)}
+    cache.clear()
+
+
+def test_argument_parser_unhashable_default(namespace_modules):
+    namespace_modules(
+        {
+            "lists": "class Commands:\n"
+            "    descr = 'lists'\n"
+            "    def cmd_plain(self, x=[1]): pass\n"
+            "COMMANDS = Commands()\n"
+        }
+    )
+    # The unsupported default is reported, not a TypeError from hashing it.
+    with pytest.raises(AssertionError, match="Unexpected arg type for \\(x\\)"):
+        commands.get_namespace("lists").argument_parser("plain")
+
+
+def test_command_names_interned():
+    system = commands.get_namespace("system")
+    for command_name in system.command_callables:
+        assert command_name is sys.intern("".join(command_name))
+
+
+def test_optional_arg_before_vararg(namespace_modules):
+    namespace_modules(
+        {
+            "varargs": "class Commands:\n"
+            "    descr = 'varargs'\n"
+            "    def cmd_x(self, a, c=4, *rest): pass\n"
+            "COMMANDS = Commands()\n"
+        }
+    )
+    with pytest.raises(
+        AssertionError, match="optional arg \\(c=4\\) before a \\*vararg"
+    ):
+        commands.get_namespace("varargs").argument_parser("x")